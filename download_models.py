@@ -1,24 +1,49 @@
 import os
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 
 def download_from_gcs(bucket_name, prefix, local_dir):
+    # Sentinel written after a complete download; one stat call decides
+    # whether anything needs to be fetched at all
+    sentinel = os.path.join(local_dir, ".ready")
+    if os.path.isfile(sentinel):
+        print(f"✅ {local_dir} already downloaded, skipping")
+        return
     print(f"📦 Downloading {prefix} from {bucket_name} → {local_dir}")
     client = storage.Client()
     bucket = client.bucket(bucket_name)
-    blobs = list(bucket.list_blobs(prefix=prefix))
+    # Only fetch the metadata fields we actually use
+    blobs = list(bucket.list_blobs(prefix=prefix, fields="items(name,size),nextPageToken"))
     if not blobs:
         print(f"⚠️ No files found in gs://{bucket_name}/{prefix}")
         return
     os.makedirs(local_dir, exist_ok=True)
+    blob_path_pairs = []
     for blob in blobs:
         if blob.size == 0:
             continue
         rel_path = os.path.relpath(blob.name, prefix)
         dest_path = os.path.join(local_dir, rel_path)
         os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-        blob.download_to_filename(dest_path)
-        print("✅", blob.name)
-    print(f"🎯 Finished downloading {len(blobs)} files from {bucket_name}/{prefix}\n")
+        blob_path_pairs.append((blob, dest_path))
+    # Parallel download; raw_download skips transcoding for non-gzipped blobs
+    results = transfer_manager.download_many(
+        blob_path_pairs,
+        max_workers=32,
+        worker_type=transfer_manager.THREAD,
+        download_kwargs={"raw_download": True},
+    )
+    failed = 0
+    for (blob, _), result in zip(blob_path_pairs, results):
+        if isinstance(result, Exception):
+            failed += 1
+            print(f"⚠️ Failed to download {blob.name}: {result}")
+        else:
+            print("✅", blob.name)
+    if failed:
+        raise RuntimeError(f"{failed} of {len(blob_path_pairs)} blobs failed to download from {bucket_name}/{prefix}")
+    open(sentinel, "w").close()
+    print(f"🎯 Finished downloading {len(blob_path_pairs)} files from {bucket_name}/{prefix}\n")
 
 #download_from_gcs("qa-model-bucket", "model/finetuned-qa-burmese", "/workspace/qa")
 download_from_gcs("speechtotext-model-bucket", "model/finetuned-seamlessm4t-burmese", "/workspace/asr")
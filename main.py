@@ -1,11 +1,22 @@
 import os
 import io
+import asyncio
+import functools
 import logging
 import base64
+import wave
 import tempfile
+import subprocess
 import requests
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter, Retry
 from flask import Flask, request, jsonify
-from google.cloud import aiplatform
+from werkzeug.http import parse_options_header
+from google.cloud import aiplatform, storage
+from google.cloud.aiplatform.gapic import PredictionServiceClient
+from google.protobuf import json_format
+from google.protobuf.struct_pb2 import Value
 from pydub import AudioSegment, utils
 
 # -----------------------------
@@ -17,6 +28,10 @@ VERTEX_ENDPOINT_ID = os.getenv(
     "VERTEX_ENDPOINT_ID",
     "projects/burmese-voice/locations/us-central1/endpoints/7279126516179402752"
 )
+# Optional: stage WAVs in GCS and send a gs:// URI instead of base64.
+# Only enable if the deployed model accepts "audio_uri"; the bucket
+# should carry a lifecycle rule expiring the tmp/ prefix.
+GCS_STAGING_BUCKET = os.getenv("GCS_STAGING_BUCKET", "")
 
 # -----------------------------
 # Flask + Logging Setup
@@ -28,14 +43,126 @@ logger = logging.getLogger("asr")
 # -----------------------------
 # Ensure ffmpeg/ffprobe paths
 # -----------------------------
-AudioSegment.converter = utils.which("ffmpeg") or "/usr/bin/ffmpeg"
-AudioSegment.ffprobe = utils.which("ffprobe") or "/usr/bin/ffprobe"
+# Resolved once at import; reused by the subprocess pipe and pydub
+FFMPEG = utils.which("ffmpeg") or "/usr/bin/ffmpeg"
+FFPROBE = utils.which("ffprobe") or "/usr/bin/ffprobe"
+AudioSegment.converter = FFMPEG
+AudioSegment.ffprobe = FFPROBE
+
+# -----------------------------
+# Pooled HTTP session for URL downloads
+# -----------------------------
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
 
 # -----------------------------
 # Vertex AI Client
 # -----------------------------
 aiplatform.init(project=PROJECT_ID, location=REGION)
-endpoint = aiplatform.Endpoint(endpoint_name=VERTEX_ENDPOINT_ID)
+# gRPC client with a persistent channel — no per-call connection setup
+prediction_client = PredictionServiceClient(
+    client_options={"api_endpoint": f"{REGION}-aiplatform.googleapis.com"}
+)
+
+staging_bucket = None
+if GCS_STAGING_BUCKET:
+    staging_bucket = storage.Client(project=PROJECT_ID).bucket(GCS_STAGING_BUCKET)
+
+# Bounded pool for CPU-bound conversion/encoding; the predict RPCs get
+# their own, wider pool so slow multi-second calls to Vertex never queue
+# behind conversions (or each other) — sized past gunicorn's 16 threads
+POOL = ThreadPoolExecutor(max_workers=4)
+PREDICT_POOL = ThreadPoolExecutor(max_workers=32)
+
+
+# -----------------------------
+# Audio Conversion
+# -----------------------------
+def _is_16k_mono_pcm_wav(audio_bytes):
+    """Check the WAV header for 16 kHz mono 16-bit PCM without decoding."""
+    try:
+        with wave.open(io.BytesIO(audio_bytes)) as w:
+            return (w.getframerate() == 16000
+                    and w.getnchannels() == 1
+                    and w.getsampwidth() == 2)
+    except (wave.Error, EOFError):
+        return False
+
+
+# mp4-family containers usually store the moov atom after mdat, so they
+# need a seekable input — ffmpeg cannot demux them from a pipe
+SEEK_FORMATS = {"m4a", "mp4", "mov", "m4b", "3gp"}
+
+# Anything at or below a bare RIFF header is a failed decode, not audio
+MIN_WAV_BYTES = 1024
+
+
+def _run_ffmpeg(src, input_bytes=None):
+    """Run ffmpeg from src (a file path or pipe:0) to 16 kHz mono WAV on stdout."""
+    proc = subprocess.Popen(
+        [FFMPEG, "-hide_banner", "-loglevel", "error", "-threads", "0",
+         "-i", src, "-ar", "16000", "-ac", "1",
+         "-acodec", "pcm_s16le", "-f", "wav", "pipe:1"],
+        stdin=subprocess.PIPE if input_bytes is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    wav_bytes, err = proc.communicate(input_bytes)
+    # ffmpeg can fail mid-demux yet still exit 0 with a header-only WAV,
+    # so a near-empty output counts as failure too
+    if proc.returncode != 0 or len(wav_bytes) < MIN_WAV_BYTES:
+        raise subprocess.CalledProcessError(proc.returncode or 1, "ffmpeg", stderr=err)
+    return wav_bytes
+
+
+def convert_to_wav_bytes(audio_bytes, fmt):
+    """Convert raw audio bytes to 16 kHz mono WAV bytes via ffmpeg."""
+    # Fast path: WAV input already in the target format needs no conversion
+    if fmt in ("wav", "wave") and _is_16k_mono_pcm_wav(audio_bytes):
+        logger.info("🎵 WAV already 16 kHz mono, skipping conversion")
+        return audio_bytes
+
+    try:
+        if fmt in SEEK_FORMATS:
+            with tempfile.NamedTemporaryFile(suffix=f".{fmt}") as tmp_in:
+                tmp_in.write(audio_bytes)
+                tmp_in.flush()
+                wav_bytes = _run_ffmpeg(tmp_in.name)
+        else:
+            wav_bytes = _run_ffmpeg("pipe:0", audio_bytes)
+        logger.info("🎵 Converted %s → 16 kHz mono WAV", fmt)
+        return wav_bytes
+    except subprocess.CalledProcessError as e:
+        logger.warning("⚠️ ffmpeg pipe failed, falling back to pydub: %s",
+                       (e.stderr or b"").decode("utf-8", "ignore").strip())
+
+    # Fallback: pydub; seek-needy formats go through a temp file since
+    # pydub feeds file-like objects to ffmpeg over a plain stdin pipe
+    try:
+        if fmt in SEEK_FORMATS:
+            with tempfile.NamedTemporaryFile(suffix=f".{fmt}") as tmp_in:
+                tmp_in.write(audio_bytes)
+                tmp_in.flush()
+                audio = AudioSegment.from_file(tmp_in.name, format=fmt,
+                                               parameters=["-threads", "0"])
+        else:
+            audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format=fmt,
+                                           parameters=["-threads", "0"])
+        # 🔥 Force 16 kHz mono conversion
+        audio = audio.set_frame_rate(16000).set_channels(1)
+        buf = io.BytesIO()
+        audio.export(buf, format="wav", parameters=["-threads", "0"])
+        logger.info("🎵 Converted %s → 16 kHz mono WAV (pydub)", fmt)
+        return buf.getvalue()
+    except Exception as e:
+        logger.warning("⚠️ Conversion fallback: %s", e)
+        return audio_bytes
 
 
 # -----------------------------
@@ -47,83 +174,139 @@ def healthz():
 
 
 # -----------------------------
-# Speech → Text API
+# Input Loaders
 # -----------------------------
-@app.route("/speech2text", methods=["POST"])
-def speech2text():
-    try:
-        content_type = request.headers.get("Content-Type", "")
-        fmt = "wav"
-        audio_bytes = None
-
-        # Case 1: multipart/form-data
-        if "multipart/form-data" in content_type:
-            file = request.files.get("file")
-            if not file:
-                return jsonify({"error": "Missing uploaded file"}), 400
-            fmt = file.filename.split(".")[-1].lower()
-            audio_bytes = file.read()
-            logger.info("📁 Multipart file: %s (%d bytes)", file.filename, len(audio_bytes))
-
-        # Case 2: raw binary
-        elif content_type.startswith("audio/"):
-            fmt = content_type.split("/")[-1]
-            audio_bytes = request.data
-            logger.info("📡 Raw audio stream (%s, %d bytes)", fmt, len(audio_bytes))
-
-        # Case 3: JSON base64 or URL
-        else:
-            data = request.get_json(silent=True) or {}
-            fmt = data.get("format", "m4a")
-            audio_b64 = data.get("audio_base64")
-            audio_url = data.get("url")
-
-            if audio_url:
-                logger.info(f"🌐 Downloading from URL: {audio_url}")
-                resp = requests.get(audio_url)
-                if resp.status_code != 200:
-                    return jsonify({"error": f"Failed to download audio from URL ({resp.status_code})"}), 400
-                audio_bytes = resp.content
-            elif audio_b64:
-                audio_bytes = base64.b64decode(audio_b64)
+# MIME type → ffmpeg/pydub format name, so pydub's heuristics are skipped
+MIME2FMT = {
+    "audio/wav": "wav",
+    "audio/x-wav": "wav",
+    "audio/wave": "wav",
+    "audio/mpeg": "mp3",
+    "audio/mp4": "m4a",
+    "audio/x-m4a": "m4a",
+    "audio/aac": "aac",
+    "audio/ogg": "ogg",
+    "audio/flac": "flac",
+    "audio/webm": "webm",
+}
+
+
+def _load_multipart(req):
+    """Case 1: multipart/form-data upload."""
+    file = req.files.get("file")
+    if not file:
+        raise ValueError("Missing uploaded file")
+    fmt = os.path.splitext(file.filename)[1][1:].lower()
+    audio_bytes = file.read()
+    logger.info("📁 Multipart file: %s (%d bytes)", file.filename, len(audio_bytes))
+    return audio_bytes, fmt
+
+
+def _load_raw_audio(req):
+    """Case 2: raw binary body with an audio/* content type."""
+    media_type, _ = parse_options_header(req.headers.get("Content-Type", ""))
+    fmt = MIME2FMT.get(media_type, media_type.split("/")[-1])
+    audio_bytes = req.data
+    logger.info("📡 Raw audio stream (%s, %d bytes)", fmt, len(audio_bytes))
+    return audio_bytes, fmt
+
+
+def _load_json(req):
+    """Case 3: JSON body with base64 audio or a download URL."""
+    data = req.get_json(silent=True) or {}
+    fmt = data.get("format", "m4a")
+    audio_b64 = data.get("audio_base64")
+    audio_url = data.get("url")
+
+    if audio_url:
+        logger.info(f"🌐 Downloading from URL: {audio_url}")
+        with SESSION.get(audio_url, timeout=(3, 30), stream=True) as resp:
+            if resp.status_code != 200:
+                raise ValueError(f"Failed to download audio from URL ({resp.status_code})")
+            n = int(resp.headers.get("Content-Length", 0))
+            if n and not resp.headers.get("Content-Encoding"):
+                # Stream into a pre-sized buffer to avoid reallocation churn.
+                # Skipped for encoded responses, where Content-Length is the
+                # compressed size but iter_content yields decoded bytes.
+                buf = bytearray(n)
+                mv = memoryview(buf)
+                off = 0
+                overflow = bytearray()
+                for chunk in resp.iter_content(65536):
+                    if overflow or off + len(chunk) > n:
+                        # Body larger than advertised — append the excess
+                        overflow += chunk
+                    else:
+                        mv[off:off + len(chunk)] = chunk
+                        off += len(chunk)
+                audio_bytes = bytes(buf[:off]) + bytes(overflow)
             else:
-                return jsonify({"error": "Missing 'audio_base64' or 'url'"}), 400
+                audio_bytes = resp.content
+        return audio_bytes, fmt
 
-        # Convert input to WAV at 16 kHz mono
-        with tempfile.NamedTemporaryFile(suffix=f".{fmt}", delete=False) as tmp_in:
-            tmp_in.write(audio_bytes)
-            tmp_in_path = tmp_in.name
+    if audio_b64:
+        return base64.b64decode(audio_b64), fmt
 
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_out:
-            tmp_out_path = tmp_out.name
+    raise ValueError("Missing 'audio_base64' or 'url'")
 
-        try:
-            audio = AudioSegment.from_file(tmp_in_path, format=fmt)
-            # 🔥 Force 16 kHz mono conversion
-            audio = audio.set_frame_rate(16000).set_channels(1)
-            audio.export(tmp_out_path, format="wav")
-            logger.info("🎵 Converted %s → 16 kHz mono WAV", fmt)
-        except Exception as e:
-            logger.warning("⚠️ Conversion fallback: %s", e)
-            tmp_out_path = tmp_in_path
-
-        # Encode to base64
-        with open(tmp_out_path, "rb") as f:
-            content = base64.b64encode(f.read()).decode("utf-8")
-
-        # Clean up
-        for path in [tmp_in_path, tmp_out_path]:
-            if os.path.exists(path):
-                os.remove(path)
-
-        # Send to Vertex endpoint
+
+HANDLERS = {
+    "multipart/form-data": _load_multipart,
+    "application/json": _load_json,
+}
+
+
+# -----------------------------
+# Speech → Text API
+# -----------------------------
+def _build_instance(wav_bytes):
+    """Build the Vertex instance proto from WAV bytes (runs in a worker thread)."""
+    if staging_bucket is not None:
+        # Stage in GCS and pass a URI — skips the ~1.33x base64 inflation
+        blob = staging_bucket.blob(f"tmp/{uuid4()}.wav")
+        blob.upload_from_string(bytes(wav_bytes), content_type="audio/wav")
+        logger.info("☁️ Staged audio at gs://%s/%s", staging_bucket.name, blob.name)
+        instance = {"audio_uri": f"gs://{staging_bucket.name}/{blob.name}",
+                    "src_lang": "mya", "tgt_lang": "mya"}
+    else:
+        content = base64.b64encode(memoryview(wav_bytes)).decode("ascii")
         instance = {"audio_base64": content, "src_lang": "mya", "tgt_lang": "mya"}
-        response = endpoint.predict(instances=[instance])
+    return json_format.ParseDict(instance, Value())
+
+
+@app.route("/speech2text", methods=["POST"])
+async def speech2text():
+    try:
+        # Single parse of the media type, then O(1) dispatch
+        media_type, _ = parse_options_header(request.headers.get("Content-Type", ""))
+        handler = HANDLERS.get(media_type) or (
+            _load_raw_audio if media_type.startswith("audio/") else _load_json
+        )
+        try:
+            audio_bytes, fmt = handler(request)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # Convert input to WAV at 16 kHz mono on the dedicated pool
+        loop = asyncio.get_running_loop()
+        wav_bytes = await loop.run_in_executor(POOL, convert_to_wav_bytes, audio_bytes, fmt)
+
+        # Encode + build the instance proto on the pool, then predict;
+        # blocking work runs off the loop so concurrent requests overlap
+        instance = await loop.run_in_executor(POOL, _build_instance, wav_bytes)
+        response = await loop.run_in_executor(
+            PREDICT_POOL,
+            functools.partial(
+                prediction_client.predict,
+                endpoint=VERTEX_ENDPOINT_ID,
+                instances=[instance],
+            ),
+        )
         logger.info("✅ Vertex response received")
 
         return jsonify({
             "status": "success",
-            "predictions": response.predictions
+            "predictions": [json_format.MessageToDict(p) for p in response.predictions]
         })
 
     except Exception as e: